@@ -18,13 +18,19 @@
 #   100MHz although mine would not accept more than 60MHz. You can try
 #   adjusting yours by simply setting "mhz=80", the max esp32 rate.
 #
-# When hybrid=False driver is pure micropython.
-# Pure Micropython could be viable when ESP32 supports Viper code emitter.
+# When hybrid=False driver is pure micropython, with the window address
+# packing in flush compiled by the Viper code emitter. This needs a
+# MicroPython with the Xtensa native emitter (v1.12 or later). The viper
+# helpers take at most 4 arguments, the limit of the MicroPython versions
+# the LVGL v7 bindings are built on.
 #
-# **NOTE** Currently "hybrid=True" has not been tested and is not implimented
+# **NOTE** Currently "hybrid=True" has not been tested.
 # Critical function for high FPS are flush and ISR.
 # when "hybrid=True", use C implementation for these functions instead of
-# pure python implementation.
+# pure python implementation. esp.gc9a01_flush is used when the espidf
+# module provides it, otherwise esp.ili9xxx_flush, which issues the same
+# column/page/memory write sequence as the GC9A01 expects. Both rely on
+# esp.ili9xxx_post_cb_isr to signal flush_ready from the SPI ISR.
 #
 ##############################################################################
 
@@ -32,10 +38,8 @@ import espidf as esp
 import lvgl as lv
 import micropython
 import ustruct
-import gc
 
 micropython.alloc_emergency_exception_buf(256)
-# gc.threshold(0x10000) # leave enough room for SPI master TX DMA buffers
 
 # Constants
 
@@ -58,9 +62,101 @@ ROTATE = {
 PORTRAIT = MADCTL_MX
 LANDSCAPE = MADCTL_MV
 
+# Pack the big-endian column (x1, x2) and page start (y1) addresses into
+# the 8-byte window buffer used by flush. The page end is always the last
+# row and is written once in disp_spi_init. Viper emits native code, so
+# this is a handful of raw stores instead of interpreted indexing.
+
+@micropython.viper
+def _pack_window(p: ptr8, x1: int, x2: int, y1: int):
+    p[0] = (x1 >> 8) & 0xFF; p[1] = x1 & 0xFF
+    p[2] = (x2 >> 8) & 0xFF; p[3] = x2 & 0xFF
+    p[4] = (y1 >> 8) & 0xFF; p[5] = y1 & 0xFF
+
+# Same as _pack_window for displays up to 256x256 pixels, where the high
+# bytes are always zero and are only cleared once, with the page end.
+
+@micropython.viper
+def _pack_window_narrow(p: ptr8, x1: int, x2: int, y1: int):
+    p[1] = x1; p[3] = x2; p[5] = y1
+
+# lv_area_t is x1, y1, x2, y2 as int16 lv_coord_t
+
+_AREA_FMT = "<hhhh"
+_AREA_SIZE = const(8)
+
+_unpack_from = ustruct.unpack_from
+
+# Init sequence, one command per line:
+#   CMD, LEN, DATA * LEN
+# with _INIT_DELAY set in LEN when a delay in ms follows the data:
+#   CMD, LEN | _INIT_DELAY, DATA * LEN, DELAY
+
+_INIT_DELAY = const(0x80)
+
+_INIT_SEQ = bytes((
+    0xEF, 1, 0x00,
+    0xEB, 1, 0x14,
+    0xFE, 1, 0x00,
+    0xEF, 1, 0x00,
+    0xEB, 1, 0x14,
+    0x84, 1, 0x40,
+    0x85, 1, 0xFF,
+    0x86, 1, 0xFF,
+    0x87, 1, 0xFF,
+    0x88, 1, 0x0A,
+    0x89, 1, 0x21,
+    0x8A, 1, 0x00,
+    0x8B, 1, 0x80,
+    0x8C, 1, 0x01,
+    0x8D, 1, 0x01,
+    0x8E, 1, 0xFF,
+    0x8F, 1, 0xFF,
+    0xB6, 2, 0x00, 0x00,
+    0x36, 1, 0x48,
+    0x00, 1, 0x00,  # Patched with the rotation, see _INIT_ROTATION_POS
+    0x3A, 1, 0x05,
+    0x90, 4, 0x08, 0x08, 0x08, 0x08,
+    0xBD, 1, 0x06,
+    0xBC, 1, 0x00,
+    0xFF, 3, 0x60, 0x01, 0x04,
+    0xC3, 1, 0x13,
+    0xC4, 1, 0x13,
+    0xC9, 1, 0x22,
+    0xBE, 1, 0x11,
+    0xE1, 2, 0x10, 0x0E,
+    0xDF, 3, 0x21, 0x0c, 0x02,
+    0xF0, 6, 0x45, 0x09, 0x08, 0x08, 0x26, 0x2A,
+    0xF1, 6, 0x43, 0x70, 0x72, 0x36, 0x37, 0x6F,
+    0xF2, 6, 0x45, 0x09, 0x08, 0x08, 0x26, 0x2A,
+    0xF3, 6, 0x43, 0x70, 0x72, 0x36, 0x37, 0x6F,
+    0xED, 2, 0x1B, 0x0B,
+    0xAE, 1, 0x77,
+    0xCD, 1, 0x63,
+    0x70, 9, 0x07, 0x07, 0x04, 0x0E, 0x0F, 0x09, 0x07, 0x08, 0x03,
+    0xE8, 1, 0x34,
+    0x62, 12, 0x18, 0x0D, 0x71, 0xED, 0x70, 0x70, 0x18, 0x0F, 0x71, 0xEF, 0x70, 0x70,
+    0x63, 12, 0x18, 0x11, 0x71, 0xF1, 0x70, 0x70, 0x18, 0x13, 0x71, 0xF3, 0x70, 0x70,
+    0x64, 7, 0x28, 0x29, 0xF1, 0x01, 0xF1, 0x00, 0x07,
+    0x66, 10, 0x3C, 0x00, 0xCD, 0x67, 0x45, 0x45, 0x10, 0x00, 0x00, 0x00,
+    0x67, 10, 0x00, 0x3C, 0x00, 0x00, 0x00, 0x01, 0x54, 0x10, 0x32, 0x98,
+    0x74, 7, 0x10, 0x85, 0x80, 0x00, 0x00, 0x4E, 0x00,
+    0x98, 2, 0x3e, 0x07,
+    0x35, 1, 0x00,
+    0x21, 1, 0x00,
+    0x11, 1 | _INIT_DELAY, 0x00, 20,
+    0x29, 1 | _INIT_DELAY, 0x00, 120,
+))
+
+# Offset of the rotation placeholder, the command right after MADCTL.
+# Looked up rather than counted, so editing the sequence cannot move it.
+
+_INIT_ROTATION_POS = _INIT_SEQ.index(b'\x36\x01\x48\x00\x01\x00') + 3
+
 class GC9A01:
 
     TRANS_BUFFER_LEN = const(16)
+    TRANS_QUEUE_LEN = const(6)      # Window setup (5) + pixel DMA (1)
 
     display_name = 'gc9a01'
 
@@ -77,7 +173,7 @@ class GC9A01:
         miso=5, mosi=18, clk=19, cs=13, dc=12, rst=4, power=14, backlight=15, backlight_on=0, power_on=0,
         spihost=esp.HSPI_HOST, mhz=60, factor=4, hybrid=False, width=240, height=240,
         colormode=COLOR_MODE_RGB, rot=PORTRAIT, invert=False, double_buffer=True, half_duplex=True,
-        asynchronous=False, initialize=True, rotation=0
+        asynchronous=False, initialize=True, rotation=0, profile=False
     ):
 
         # Initializations
@@ -85,6 +181,9 @@ class GC9A01:
         self.asynchronous = asynchronous
         self.initialize = initialize
 
+        # Flush timing and monitor statistics, reported by stat()
+        self._profile = profile
+
         self.width = width
         self.height = height
 
@@ -101,19 +200,19 @@ class GC9A01:
         self.spihost = spihost
         self.mhz = mhz
         self.factor = factor
-        self.hybrid = hybrid
+        self.hybrid_flush = getattr(esp, 'gc9a01_flush', None) or getattr(esp, 'ili9xxx_flush', None)
+        self.hybrid = hybrid and self.hybrid_flush is not None and hasattr(esp, 'ili9xxx_post_cb_isr')
         self.half_duplex = half_duplex
 
-        self.buf_size = (self.width * self.height * lv.color_t.SIZE) // factor
-
-        if invert:
-            self.init_cmds.append({'cmd': 0x21})
+        self.invert = invert
 
         # Register display driver 
 
+        self.buf_size = (self.width * self.height * lv.color_t.SIZE) // factor
+
         self.buf1 = esp.heap_caps_malloc(self.buf_size, esp.MALLOC_CAP.DMA)
         self.buf2 = esp.heap_caps_malloc(self.buf_size, esp.MALLOC_CAP.DMA) if double_buffer else None
-        
+
         if self.buf1 and self.buf2:
             print("Double buffer")
         elif self.buf1:
@@ -130,70 +229,31 @@ class GC9A01:
 
         self.disp_drv.user_data = {'dc': self.dc, 'spi': self.spi, 'dt': 0}
         self.disp_drv.buffer = self.disp_buf
-        self.disp_drv.flush_cb = esp.ili9xxx_flush if hybrid and hasattr(esp, 'ili9xxx_flush') else self.flush
-        self.disp_drv.monitor_cb = self.monitor
+        self.disp_drv.flush_cb = self.hybrid_flush if self.hybrid else self.flush
+        self.disp_drv.monitor_cb = self.monitor if profile else None
         self.disp_drv.hor_res = self.width
         self.disp_drv.ver_res = self.height
+
+        # When the binding can expose the memory of a struct, flush reads
+        # the whole area in one unpack instead of four attribute reads.
+
+        self.area_unpack = hasattr(lv.area_t(), '__dereference__')
         
-        if rotation not in ROTATE.keys():
-            raise RuntimeError('Rotation must be 0, 90, 180 or 270.')
-        else:
+        try:
             self.rotation = ROTATE[rotation]
+        except KeyError:
+            raise RuntimeError('Rotation must be 0, 90, 180 or 270.')
 
+        # Copy the init sequence into DMA-able memory once, so that command
+        # data can be transmitted as is instead of through trans_buffer
 
-        self.init_cmds = [
-            {'cmd': 0xEF, 'data': bytes([0])},
-            {'cmd': 0xEB, 'data': bytes([0x14])},
-            {'cmd': 0xFE, 'data': bytes([0])},
-            {'cmd': 0xEF, 'data': bytes([0])},
-            {'cmd': 0xEB, 'data': bytes([0x14])},
-            {'cmd': 0x84, 'data': bytes([0x40])},
-            {'cmd': 0x85, 'data': bytes([0xFF])},
-            {'cmd': 0x86, 'data': bytes([0xFF])},
-            {'cmd': 0x87, 'data': bytes([0xFF])},
-            {'cmd': 0x88, 'data': bytes([0x0A])},
-            {'cmd': 0x89, 'data': bytes([0x21])},
-            {'cmd': 0x8A, 'data': bytes([0x00])},
-            {'cmd': 0x8B, 'data': bytes([0x80])},
-            {'cmd': 0x8C, 'data': bytes([0x01])},
-            {'cmd': 0x8D, 'data': bytes([0x01])},
-            {'cmd': 0x8E, 'data': bytes([0xFF])},
-            {'cmd': 0x8F, 'data': bytes([0xFF])},
-            {'cmd': 0xB6, 'data': bytes([0x00, 0x00])}, 
-            {'cmd': 0x36, 'data': bytes([0x48])},
-            {'cmd': self.rotation, 'data': bytes([0])},
-            {'cmd': 0x3A, 'data': bytes([0x05])},
-            {'cmd': 0x90, 'data': bytes([0x08, 0x08, 0x08, 0x08])},
-            {'cmd': 0xBD, 'data': bytes([0x06])},
-            {'cmd': 0xBC, 'data': bytes([0x00])},
-            {'cmd': 0xFF, 'data': bytes([0x60, 0x01, 0x04])},
-            {'cmd': 0xC3, 'data': bytes([0x13])},
-            {'cmd': 0xC4, 'data': bytes([0x13])},
-            {'cmd': 0xC9, 'data': bytes([0x22])},
-            {'cmd': 0xBE, 'data': bytes([0x11])},
-            {'cmd': 0xE1, 'data': bytes([0x10, 0x0E])},
-            {'cmd': 0xDF, 'data': bytes([0x21, 0x0c, 0x02])},
-            {'cmd': 0xF0, 'data': bytes([0x45, 0x09, 0x08, 0x08, 0x26, 0x2A])},
-            {'cmd': 0xF1, 'data': bytes([0x43, 0x70, 0x72, 0x36, 0x37, 0x6F])},
-            {'cmd': 0xF2, 'data': bytes([0x45, 0x09, 0x08, 0x08, 0x26, 0x2A])},
-            {'cmd': 0xF3, 'data': bytes([0x43, 0x70, 0x72, 0x36, 0x37, 0x6F])},
-            {'cmd': 0xED, 'data': bytes([0x1B, 0x0B])},
-            {'cmd': 0xAE, 'data': bytes([0x77])},
-            {'cmd': 0xCD, 'data': bytes([0x63])},
-            {'cmd': 0x70, 'data': bytes([0x07, 0x07, 0x04, 0x0E, 0x0F, 0x09, 0x07, 0x08, 0x03])},
-            {'cmd': 0xE8, 'data': bytes([0x34])},
-            {'cmd': 0x62, 'data': bytes([0x18, 0x0D, 0x71, 0xED, 0x70, 0x70, 0x18, 0x0F, 0x71, 0xEF, 0x70, 0x70])},
-            {'cmd': 0x63, 'data': bytes([0x18, 0x11, 0x71, 0xF1, 0x70, 0x70, 0x18, 0x13, 0x71, 0xF3, 0x70, 0x70])},
-            {'cmd': 0x64, 'data': bytes([0x28, 0x29, 0xF1, 0x01, 0xF1, 0x00, 0x07])},
-            {'cmd': 0x66, 'data': bytes([0x3C, 0x00, 0xCD, 0x67, 0x45, 0x45, 0x10, 0x00, 0x00, 0x00])},
-            {'cmd': 0x67, 'data': bytes([0x00, 0x3C, 0x00, 0x00, 0x00, 0x01, 0x54, 0x10, 0x32, 0x98])},
-            {'cmd': 0x74, 'data': bytes([0x10, 0x85, 0x80, 0x00, 0x00, 0x4E, 0x00])},
-            {'cmd': 0x98, 'data': bytes([0x3e, 0x07])},
-            {'cmd': 0x35, 'data': bytes([0])},
-            {'cmd': 0x21, 'data': bytes([0])},
-            {'cmd': 0x11, 'data': bytes([0]), 'delay': 20},
-            {'cmd': 0x29, 'data': bytes([0]), 'delay': 120}
-        ]
+        self.init_buffer = esp.heap_caps_malloc(len(_INIT_SEQ), esp.MALLOC_CAP.DMA)
+        if not self.init_buffer:
+            raise RuntimeError("Not enough DMA-able memory to allocate init sequence")
+
+        self.init_seq = self.init_buffer.__dereference__(len(_INIT_SEQ))
+        self.init_seq[:] = _INIT_SEQ
+        self.init_seq[_INIT_ROTATION_POS] = self.rotation
 
         if self.initialize:
             self.init()
@@ -229,19 +289,17 @@ class GC9A01:
             "clock_speed_hz": self.mhz*1000*1000,   # Clock out at DISP_SPI_MHZ MHz
             "mode": 0,                              # SPI mode 0
             "spics_io_num": self.cs,                # CS pin
-            "queue_size": 2,
+            "queue_size": TRANS_QUEUE_LEN,
             "flags": devcfg_flags,
             "duty_cycle_pos": 128,
         })
 
-#         if self.hybrid and hasattr(esp, 'ili9xxx_post_cb_isr'):
-#             devcfg.pre_cb = None
-#             devcfg.post_cb = esp.ili9xxx_post_cb_isr
-#         else:
-#             devcfg.pre_cb = esp.ex_spi_pre_cb_isr
-#             devcfg.post_cb = esp.ex_spi_post_cb_isr
-        devcfg.pre_cb = esp.ex_spi_pre_cb_isr
-        devcfg.post_cb = esp.ex_spi_post_cb_isr
+        if self.hybrid:
+            devcfg.pre_cb = None
+            devcfg.post_cb = esp.ili9xxx_post_cb_isr
+        else:
+            devcfg.pre_cb = esp.ex_spi_pre_cb_isr
+            devcfg.post_cb = esp.ex_spi_post_cb_isr
 
         esp.gpio_pad_select_gpio(self.cs)
 
@@ -267,6 +325,28 @@ class GC9A01:
         self.cmd_trans_data = self.trans_buffer.__dereference__(1)
         self.word_trans_data = self.trans_buffer.__dereference__(4)
 
+        # Window setup buffer used by flush. Layout (all DMA-able):
+        #   [0:4]  column address data (x1, x2)
+        #   [4:8]  page address data (y1, height - 1)
+        #   [8]    SET_COLUMN, [9] SET_PAGE, [10] WRITE_RAM, [11] WRITE_RAM_CONTINUE
+
+        self.window_buffer = esp.heap_caps_malloc(TRANS_BUFFER_LEN, esp.MALLOC_CAP.DMA)
+        window_data = self.window_buffer.__dereference__(TRANS_BUFFER_LEN)
+        window_data[8] = 0x2A
+        window_data[9] = 0x2B
+        window_data[10] = 0x2C
+        window_data[11] = 0x3C
+        self.window_trans_data = window_data[0:8]
+        window_data[6] = ((self.height - 1) >> 8) & 0xFF
+        window_data[7] = (self.height - 1) & 0xFF
+        if self.width <= 256 and self.height <= 256:
+            window_data[0] = window_data[2] = window_data[4] = 0
+            self.pack_window = _pack_window_narrow
+        else:
+            self.pack_window = _pack_window
+        self.col_trans_data = window_data[0:4]
+        self.page_trans_data = window_data[4:8]
+
         # Attach the LCD to the SPI bus
 
         ptr_to_spi = esp.C_Pointer()
@@ -274,30 +354,66 @@ class GC9A01:
         if ret != 0: raise RuntimeError("Failed adding SPI device")
         self.spi = ptr_to_spi.ptr_val
 
-        self.bytes_transmitted = 0
-        completed_spi_transaction = esp.spi_transaction_t()
-        cast_spi_transaction_instance = esp.spi_transaction_t.cast_instance
+        # Bound once, so the ISR does no attribute lookups on the way to
+        # signal LVGL. The C path (hybrid=True) uses ili9xxx_post_cb_isr.
 
-        def post_isr(arg):
-            reported_transmitted = self.bytes_transmitted
-            if reported_transmitted > 0:
-                print('- Completed DMA of %d bytes (mem_free=0x%X)' % (reported_transmitted , gc.mem_free()))
-                self.bytes_transmitted -= reported_transmitted
+        flush_ready = self.disp_drv.flush_ready
+        get_ccount = esp.get_ccount
+        end_time_ptr = self.end_time_ptr
 
         # Called in ISR context!
         def flush_isr(spi_transaction_ptr):
-            self.disp_drv.flush_ready()
+            flush_ready()
             # esp.spi_device_release_bus(self.spi)
-            esp.get_ccount(self.end_time_ptr)
-
-            # cast_spi_transaction_instance(completed_spi_transaction, spi_transaction_ptr)
-            # self.bytes_transmitted += completed_spi_transaction.length
-            # try:
-            #     micropython.schedule(post_isr, None)
-            # except RuntimeError:
-            #     pass
-        
-        self.spi_callbacks = esp.spi_transaction_set_cb(None, flush_isr)
+
+        # Called in ISR context!
+        def flush_isr_profile(spi_transaction_ptr):
+            flush_ready()
+            get_ccount(end_time_ptr)
+
+        # DC is driven from the pre-transaction callback so that queued
+        # command and data transactions can be chained without waiting
+        # for each one to complete.
+
+        dc = self.dc
+        gpio_set_level = esp.gpio_set_level
+
+        self._gpio_set_level = gpio_set_level
+
+        # Called in ISR context!
+        def dc_cmd_isr(spi_transaction_ptr):
+            gpio_set_level(dc, 0)           # Command mode
+
+        # Called in ISR context!
+        def dc_data_isr(spi_transaction_ptr):
+            gpio_set_level(dc, 1)           # Data mode
+
+        self.spi_cmd_callbacks = esp.spi_transaction_set_cb(dc_cmd_isr, None)
+        self.spi_data_callbacks = esp.spi_transaction_set_cb(dc_data_isr, None)
+        self.spi_callbacks = esp.spi_transaction_set_cb(dc_data_isr, flush_isr_profile if self._profile else flush_isr)
+
+        # Pre-built window setup transactions, only the address bytes
+        # change between flushes.
+
+        def window_trans(data, callbacks):
+            trans = esp.spi_transaction_t()
+            trans.length = len(data) * 8
+            trans.tx_buffer = data
+            trans.user = callbacks
+            return trans
+
+        self.trans_setcol = window_trans(window_data[8:9], self.spi_cmd_callbacks)
+        self.trans_coldata = window_trans(self.col_trans_data, self.spi_data_callbacks)
+        self.trans_setpage = window_trans(window_data[9:10], self.spi_cmd_callbacks)
+        self.trans_pagedata = window_trans(self.page_trans_data, self.spi_data_callbacks)
+        self.trans_writeram = window_trans(window_data[10:11], self.spi_cmd_callbacks)
+        self.trans_writecont = window_trans(window_data[11:12], self.spi_cmd_callbacks)
+
+        # Transaction pool for queue_trans, one per device queue slot
+
+        self.trans_pool = [esp.spi_transaction_t() for i in range(TRANS_QUEUE_LEN)]
+        self.trans_pool_idx = 0
+        self.trans_pending = 0
 
     #
     # Deinitialize SPI device and bus, and free memory
@@ -350,6 +466,14 @@ class GC9A01:
             esp.heap_caps_free(self.trans_buffer)
             self.trans_buffer = None
 
+        if self.window_buffer:
+            esp.heap_caps_free(self.window_buffer)
+            self.window_buffer = None
+
+        if self.init_buffer:
+            esp.heap_caps_free(self.init_buffer)
+            self.init_buffer = None
+
 
     ######################################################
 
@@ -363,38 +487,82 @@ class GC9A01:
         self.trans.user = None
         esp.spi_device_polling_transmit(self.spi, self.trans)
     
+    trans_dma = esp.spi_transaction_t()
+
     def spi_send_dma(self, data):
-        self.trans.length = len(data) * 8   # Length is in bytes, transaction length is in bits. 
-        self.trans.tx_buffer = data         # data should be allocated as DMA-able memory
-        self.trans.user = self.spi_callbacks
-        esp.spi_device_queue_trans(self.spi, self.trans, -1)
+        self.trans_dma.length = len(data) * 8   # Length is in bytes, transaction length is in bits.
+        self.trans_dma.tx_buffer = data         # data should be allocated as DMA-able memory
+        self.trans_dma.user = self.spi_callbacks
+        ret = esp.spi_device_queue_trans(self.spi, self.trans_dma, -1)
+        if ret != 0:
+            # No post callback will come for a rejected transaction, release
+            # LVGL here so that it does not wait for flush_ready forever.
+            # This runs inside LVGL's flush callback, so report instead of
+            # raising through lv_task_handler.
+            self.disp_drv.flush_ready()
+            print("Failed queuing SPI DMA transaction of %d bytes (%d)" % (len(data), ret))
     
+    def queue_trans(self, data, callbacks):    # data should be allocated as DMA-able memory
+        pool = self.trans_pool
+        if self.trans_pending == len(pool):
+            # Results come back in order, so this frees the slot reused below
+            esp.spi_device_get_trans_result(self.spi, self.trans_result_ptr, -1)
+            self.trans_pending -= 1
+        trans = pool[self.trans_pool_idx]
+        self.trans_pool_idx = (self.trans_pool_idx + 1) % len(pool)
+        trans.length = len(data) * 8
+        trans.tx_buffer = data
+        trans.user = callbacks
+        esp.spi_device_queue_trans(self.spi, trans, -1)
+        self.trans_pending += 1
+
+    def wait_trans(self):
+        while self.trans_pending:
+            esp.spi_device_get_trans_result(self.spi, self.trans_result_ptr, -1)
+            self.trans_pending -= 1
+
     ######################################################
     ######################################################
 
     def send_cmd(self, cmd):
-        esp.gpio_set_level(self.dc, 0)	    # Command mode
+        self._gpio_set_level(self.dc, 0)    # Command mode
         self.cmd_trans_data[0] = cmd
         self.spi_send(self.cmd_trans_data)
 
     def send_data(self, data):
-        esp.gpio_set_level(self.dc, 1)	    # Data mode
+        self._gpio_set_level(self.dc, 1)    # Data mode
         if len(data) > TRANS_BUFFER_LEN: raise RuntimeError('Data too long, please use DMA!')
         trans_data = self.trans_buffer.__dereference__(len(data))
-        trans_data[:] = data[:]
+        trans_data[:] = data
         self.spi_send(trans_data)
 
+    def send_trans_cmd(self, cmd):          # cmd should be allocated as DMA-able memory
+        self._gpio_set_level(self.dc, 0)    # Command mode
+        self.spi_send(cmd)
+
+    def send_trans_data(self, data):        # data should be allocated as DMA-able memory
+        self._gpio_set_level(self.dc, 1)    # Data mode
+        self.spi_send(data)
+
+    def queue_cmd(self, cmd):               # cmd should be allocated as DMA-able memory
+        self.queue_trans(cmd, self.spi_cmd_callbacks)
+
+    def queue_data(self, data):             # data should be allocated as DMA-able memory
+        self.queue_trans(data, self.spi_data_callbacks)
+
     def send_trans_word(self):
-        esp.gpio_set_level(self.dc, 1)	    # Data mode
+        self._gpio_set_level(self.dc, 1)    # Data mode
         self.spi_send(self.word_trans_data)
 
     def send_data_dma(self, data):          # data should be allocated as DMA-able memory
-        esp.gpio_set_level(self.dc, 1)      # Data mode
-        self.spi_send_dma(data)
+        self.spi_send_dma(data)             # Data mode is set by the pre-transaction callback
 
     ######################################################
 
-    async def _init(self, sleep_func):
+    def _init_steps(self):
+
+        # Runs the whole init sequence, yielding each delay in ms for the
+        # caller to sleep, so init and init_async share one sequence.
 
         # Initialize non-SPI GPIOs
 
@@ -412,24 +580,54 @@ class GC9A01:
 
         if self.power != -1:
             esp.gpio_set_level(self.power, self.power_on)
-            await sleep_func(100)
+            yield 100
 
         # Reset the display
 
         if self.rst != -1:
             esp.gpio_set_level(self.rst, 0)
-            await sleep_func(100)
+            yield 100
             esp.gpio_set_level(self.rst, 1)
-            await sleep_func(100)
+            yield 100
 
         # Send all the commands
-
-        for cmd in self.init_cmds:
-            self.send_cmd(cmd['cmd'])
-            if 'data' in cmd:
-                self.send_data(cmd['data'])
-            if 'delay' in cmd:
-                await sleep_func(cmd['delay'])
+        #
+        # Commands and data are sent straight from the DMA copy of the
+        # sequence. They are queued back-to-back with DC driven from the
+        # pre-transaction callbacks, except with hybrid=True, where the C
+        # post callback owns the transaction user field and DC is set here.
+
+        if self.hybrid:
+            send_cmd, send_data = self.send_trans_cmd, self.send_trans_data
+        else:
+            send_cmd, send_data = self.queue_cmd, self.queue_data
+
+        seq = self.init_seq
+        pos = 0
+        while pos < len(seq):
+            send_cmd(seq[pos:pos + 1])
+            length = seq[pos + 1]
+            pos += 2
+            delay = length & _INIT_DELAY
+            length &= ~_INIT_DELAY
+            if length:
+                send_data(seq[pos:pos + length])
+                pos += length
+            if delay:
+                self.wait_trans()
+                yield seq[pos]
+                pos += 1
+        self.wait_trans()
+
+        # The init sequence turns display inversion on (INVON), which is
+        # what GC9A01 panels need for normal colors. invert flips that.
+
+        if self.invert:
+            self.send_cmd(0x20)             # INVOFF
+
+        # Column addresses are unknown after a reset, force flush to set them
+
+        self.last_x1 = self.last_x2 = -1
 
         print("{} initialization completed".format(self.display_name))
 
@@ -442,20 +640,15 @@ class GC9A01:
         # Register the driver
         self.disp_drv.register()
 
-    
     def init(self):
         import utime
-        generator = self._init(lambda ms:(yield ms))
-        try:
-            while True:
-                ms = next(generator)
-                utime.sleep_ms(ms)
-        except StopIteration:
-            pass
+        for ms in self._init_steps():
+            utime.sleep_ms(ms)
 
     async def init_async(self):
         import uasyncio
-        await self._init(uasyncio.sleep_ms)
+        for ms in self._init_steps():
+            await uasyncio.sleep_ms(ms)
 
     def power_down(self):
 
@@ -468,6 +661,10 @@ class GC9A01:
     
     ######################################################
 
+    last_x1 = -1
+    last_x2 = -1
+    last_y2 = -2
+
     start_time_ptr = esp.C_Pointer()
     end_time_ptr = esp.C_Pointer()
     flush_acc_setup_cycles = 0
@@ -475,47 +672,77 @@ class GC9A01:
 
     def flush(self, disp_drv, area, color_p):
 
-        if self.end_time_ptr.int_val and self.end_time_ptr.int_val > self.start_time_ptr.int_val:
-            self.flush_acc_dma_cycles +=  self.end_time_ptr.int_val - self.start_time_ptr.int_val
+        # Bind everything used below once, attribute lookups are not free
 
-        esp.get_ccount(self.start_time_ptr)
+        queue_trans = esp.spi_device_queue_trans
+        get_trans_result = esp.spi_device_get_trans_result
+        trans_result_ptr = self.trans_result_ptr
+        spi = self.spi
+        profile = self._profile
+        if self.area_unpack:
+            x1, y1, x2, y2 = _unpack_from(_AREA_FMT, area.__dereference__(_AREA_SIZE))
+        else:
+            x1, x2, y1, y2 = area.x1, area.x2, area.y1, area.y2
+
+        if profile:
+            st = self.start_time_ptr
+            et = self.end_time_ptr
+            if et.int_val and et.int_val > st.int_val:
+                self.flush_acc_dma_cycles += et.int_val - st.int_val
+            esp.get_ccount(st)
 
         # esp.spi_device_acquire_bus(self.spi, esp.ESP.MAX_DELAY)
 
-        # Column addresses
+        # Collect the results of the previous flush's queued transactions,
+        # which are all done since LVGL waits for flush_ready before calling
+        # flush again. This keeps the device result queue from filling up.
+
+        while get_trans_result(spi, trans_result_ptr, 0) == 0:
+            pass
 
-        self.send_cmd(0x2A);
+        # Queue the window setup back-to-back, then memory write by DMA,
+        # disp_flush_ready when finished.
+        #
+        # The page window always ends at the last row, so when an area
+        # starts right below the previous one with the same columns (LVGL
+        # flushing a frame in bands) the display's memory pointer is
+        # already in place and a memory write continue is all it takes.
 
-        self.word_trans_data[0] = (area.x1 >> 8) & 0xFF
-        self.word_trans_data[1] = area.x1 & 0xFF
-        self.word_trans_data[2] = (area.x2 >> 8) & 0xFF
-        self.word_trans_data[3] = area.x2 & 0xFF
-        self.send_trans_word()
+        if x1 == self.last_x1 and x2 == self.last_x2 and y1 == self.last_y2 + 1:
+            queue_trans(spi, self.trans_writecont, -1)
+        else:
 
-        # Page addresses
+            # Column and page addresses, updated in place in DMA memory
 
-        self.send_cmd(0x2B);
+            self.pack_window(self.window_trans_data, x1, x2, y1)
 
-        self.word_trans_data[0] = (area.y1 >> 8) & 0xFF
-        self.word_trans_data[1] = area.y1 & 0xFF
-        self.word_trans_data[2] = (area.y2 >> 8) & 0xFF
-        self.word_trans_data[3] = area.y2 & 0xFF
-        self.send_trans_word()
+            # The column addresses are kept by the display, so they are only
+            # sent when they change, which saves two transactions per flush
+            # for full-width partial refreshes.
 
-        # Memory write by DMA, disp_flush_ready when finished
+            if x1 != self.last_x1 or x2 != self.last_x2:
+                queue_trans(spi, self.trans_setcol, -1)
+                queue_trans(spi, self.trans_coldata, -1)
+                self.last_x1 = x1
+                self.last_x2 = x2
 
-        self.send_cmd(0x2C)
+            queue_trans(spi, self.trans_setpage, -1)
+            queue_trans(spi, self.trans_pagedata, -1)
+            queue_trans(spi, self.trans_writeram, -1)
 
-        size = (area.x2 - area.x1 + 1) * (area.y2 - area.y1 + 1)
+        self.last_y2 = y2
+
+        size = (x2 - x1 + 1) * (y2 - y1 + 1)
         data_view = color_p.__dereference__(size * lv.color_t.SIZE)
 
-        esp.get_ccount(self.end_time_ptr)
-        if self.end_time_ptr.int_val > self.start_time_ptr.int_val:
-            self.flush_acc_setup_cycles += self.end_time_ptr.int_val - self.start_time_ptr.int_val
-        esp.get_ccount(self.start_time_ptr)
+        if profile:
+            esp.get_ccount(et)
+            if et.int_val > st.int_val:
+                self.flush_acc_setup_cycles += et.int_val - st.int_val
+            esp.get_ccount(st)
 
         self.send_data_dma(data_view)
-        
+
     ######################################################
 
     monitor_acc_time = 0